@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
-import math
+import io
+import os
+import sys
+
+import numba
+import numpy as np
 
 from midifile import MidiFile
 
@@ -37,33 +42,114 @@ def freq_for_note(note):
     """
     map midi-note to frequency
     """
-    return 440 * 2**((note-69)/12)
+    return FREQ[note]
 
 def speed_for_note(axis, note):
     """
     map midi-note to speed for a given axis,
     return 0 if target speed is outside of range
     """
-    speed = freq_for_note(note) * CALIBRATION[axis]
-    lo, hi = SPEED_RANGES[axis]
-    if lo <= speed <= hi:
-        return speed
-    else:
-        return 0
+    return SPEED[AXIS_INDEX[axis]][note]
+
+# map axes to channel indices (inverse of AXIS)
+AXIS_INDEX = {axis: channel for channel, axis in AXIS.items()}
+
+# the axis dicts above are config; the hot path works on fixed
+# length-3 arrays indexed by channel instead
+LO = np.array([LIMITS_MM[AXIS[c]][0] for c in range(3)], dtype=float)
+HI = np.array([LIMITS_MM[AXIS[c]][1] for c in range(3)], dtype=float)
+SPAN = HI - LO
+
+# precomputed per-note lookup tables, midi-notes are always 0..127
+FREQ = np.array([440 * 2**((note-69)/12) for note in range(128)])
+SPEED = np.stack([
+    np.where((lo <= FREQ*CALIBRATION[axis]) & (FREQ*CALIBRATION[axis] <= hi),
+             FREQ*CALIBRATION[axis], 0)
+    for axis, (lo, hi) in ((AXIS[c], SPEED_RANGES[AXIS[c]]) for c in range(3))
+])
+
+# bound .format methods for the hot-loop lines, so the format spec
+# isn't re-parsed per emitted line
+G1_FMT = "G1 X{:.3f} Y{:.3f} Z{:.3f} F{:.0f}\n".format
+G4_FMT = "G4 S{:.5}\n".format
+
+@numba.njit(cache=True)
+def _plan_move(pos, last_dir, lo, hi, distances, out):
+    """
+    Move-splitting kernel: advance `pos` by `distances`, splitting into
+    back-and-forth sub-moves where the limits require it
+    Emits one position per sub-move into `out` and returns their count
+    (-1 if a distance can't fit, which the caller has ruled out)
+    """
+    n = 0
+    while True:
+        # cheap containment check first: most moves fit without a split,
+        # so bail out of the scan on the first axis that does
+        fits_all = True
+        for a in range(3):
+            if distances[a] > max(pos[a] - lo[a], hi[a] - pos[a]):
+                fits_all = False
+                break
+        min_fraction = 1.0
+        if not fits_all:
+            # how far the remaining distances overshoot the limits
+            for a in range(3):
+                max_d = max(pos[a] - lo[a], hi[a] - pos[a])
+                if distances[a] > max_d:
+                    fraction = max_d/distances[a]
+                    if fraction < min_fraction:
+                        min_fraction = fraction
+        # try to maintain the last direction, flip axes where it doesn't fit
+        flipped_any = False
+        for a in range(3):
+            d = distances[a]*min_fraction
+            if not fits_all:
+                # rounding can push d one ulp past the reachable distance,
+                # leaving the target just outside the limits in both
+                # directions; clamp the sub-move so it always fits
+                max_d = max(pos[a] - lo[a], hi[a] - pos[a])
+                if d > max_d:
+                    d = max_d
+            if a == 2 and flipped_any and last_dir[2] > 0:
+                # an X/Y flip re-prefers moving the Z-axis down
+                last_dir[2] = -1
+            target = pos[a] + d*last_dir[a]
+            if lo[a] <= target <= hi[a]:
+                pos[a] = target
+            else:
+                target = pos[a] - d*last_dir[a]
+                if lo[a] <= target <= hi[a]:
+                    last_dir[a] = -last_dir[a]
+                    pos[a] = target
+                    flipped_any = True
+                else:
+                    return -1
+        if flipped_any:
+            # prefer moving the Z-axis down
+            last_dir[2] = -1
+        out[n, 0] = pos[0]
+        out[n, 1] = pos[1]
+        out[n, 2] = pos[2]
+        n += 1
+        if fits_all:
+            return n
+        for a in range(3):
+            distances[a] -= distances[a]*min_fraction
 
 
 class Midi2Gcode:
     def __init__(self, midifile):
         self.midifile = midifile
-        self._last_dir = {
-            'X':1,
-            'Y':1,
-            'Z':1
-        }
+        self._last_dir = np.ones(3, dtype=np.int8)
+        # stdout with a large buffer, so emitting millions of G-code lines
+        # doesn't mean millions of write syscalls
+        self._out = io.TextIOWrapper(
+            os.fdopen(os.dup(sys.stdout.fileno()), 'wb', buffering=1<<20),
+            write_through=False)
         self._reset()
 
     def _reset(self):
-        self._pos = {axis: min(limits) for axis, limits in LIMITS_MM.items()}
+        self._pos = LO.copy()
 
     def _print_prologue(self):
         print("""
@@ -79,50 +165,37 @@ M205 S0 T0 ; sets the minimum extruding and travel feed rate, mm/sec
 G21 ; set units to millimeters
 G90 ; use absolute coordinates
 G28 W ; home without bed leveling
-        """)
+        """, file=self._out)
 
         print(f"""
-G1 X{self._pos['X']:.3f} Y{self._pos['Y']:.3f} Z{self._pos['Z']:.3f} ; move to start position
+G1 X{self._pos[0]:.3f} Y{self._pos[1]:.3f} Z{self._pos[2]:.3f} ; move to start position
 G4 S1 ; wait a little
-        """)
+        """, file=self._out)
 
 
     def _print_epilogue(self):
         print("""
 M84 ; disable steppers
-        """)
+        """, file=self._out)
 
     def move(self, distances):
         """
         Generate positions so that the entire distances are covered
+        `distances` is a length-3 array of per-axis distances (0 = axis doesn't move)
         May split the move into multiple back-and-forth moves to accomodate long distances
         """
-        max_distances = {axis: max(abs(self._pos[axis] - l) for l in LIMITS_MM[axis]) for axis in distances.keys()}
-        if all(max_distances[axis] >= distance for axis, distance in distances.items()):
-            # yep, we can move the entire distance in a single move
-            # try to maintain the last direction
-            for axis, distance in distances.items():
-                lo, hi = LIMITS_MM[axis]
-                if lo <= self._pos[axis] + distance*self._last_dir[axis] <= hi:
-                    # desired direction fits? all good
-                    self._pos[axis] += distance*self._last_dir[axis]
-                    continue
-                elif lo <= self._pos[axis] -distance*self._last_dir[axis] <= hi:
-                    # inverse direction fits? record it
-                    self._last_dir[axis] *= -1
-                    self._pos[axis] += distance*self._last_dir[axis]
-                else:
-                    # this case should not happen, as we have checked the distance before!
-                    raise ValueError()
-                # prefer moving the Z-axis down
-                self._last_dir['Z'] = -1
-            yield self._pos
-        else:
-            min_fraction = min(max_distances[axis]/distance for axis, distance in distances.items())
-            part1 = {axis: distance*min_fraction for axis, distance in distances.items()}
-            yield from self.move(part1)
-            part2 = {axis: distance*(1-min_fraction) for axis, distance in distances.items()}
-            yield from self.move(part2)
+        remaining = np.array(distances, dtype=float)
+        # every sub-move covers at least half the range of its tightest axis
+        bound = int(np.ceil(2*remaining/SPAN).sum()) + 1
+        out = np.empty((bound, 3))
+        n = _plan_move(self._pos, self._last_dir, LO, HI, remaining, out)
+        if n < 0:
+            # this case should not happen, as the distances always fit the limits!
+            raise ValueError()
+        for i in range(n):
+            # plain float tuples: cheaper than array-row views and safe to
+            # keep around after the next sub-move
+            yield float(out[i, 0]), float(out[i, 1]), float(out[i, 2])
 
 
 
@@ -130,26 +203,38 @@ M84 ; disable steppers
         self._reset()
         self._print_prologue()
 
-        for duration, state in self.midifile.monophone_notes():
-            duration_seconds = duration/self.midifile.ticks_per_second
-
-            if duration_seconds < 0.01: # skip events shorter than 10ms
-                continue
-            
-            if not state: # no active notes? -> just wait
-                print(f"G4 S{duration_seconds:.5}")
+        notes = self.midifile.monophone_notes_array()
+        # drop events shorter than 10ms before doing any per-event work
+        notes = notes[notes[:, 0] >= 0.01*self.midifile.ticks_per_second]
+        durations_seconds = notes[:, 0] / self.midifile.ticks_per_second
+        keys = notes[:, 1:]
+
+        # index the per-axis lookup tables for all events at once
+        speeds = np.stack([SPEED[channel][keys[:, channel]] for channel in range(3)], axis=1)
+        speeds[keys < 0] = 0 # inactive channels don't move
+        speeds_combined = np.linalg.norm(speeds, axis=1) # combine speed values into global speed
+        all_distances = durations_seconds[:, None] * speeds/60 # speed is in mm/min
+
+        # collect lines and emit them in large chunks: "".join runs in C,
+        # one write per chunk instead of one per line
+        lines = []
+        lines_append = lines.append
+        for i, duration_seconds in enumerate(durations_seconds):
+            if (keys[i] < 0).all(): # no active notes? -> just wait
+                lines_append(G4_FMT(duration_seconds))
                 continue
-            
-            speeds = {AXIS[channel]: speed_for_note(AXIS[channel], key) for channel, key in state}
-            speed_combined = math.sqrt(sum(speed*speed for speed in speeds.values())) # combine speed values into global speed
 
-            distances = {axis: duration_seconds * speed/60 for axis, speed in speeds.items()} # speed is in mm/min
-            for pos in self.move(distances):
-                print(f"G1 X{pos['X']:.3f} Y{pos['Y']:.3f} Z{pos['Z']:.3f} F{speed_combined:.0f}")
+            for pos in self.move(all_distances[i]):
+                lines_append(G1_FMT(*pos, speeds_combined[i]))
 
+            if len(lines) >= 65536:
+                self._out.write("".join(lines))
+                lines.clear()
 
+        self._out.write("".join(lines))
 
         self._print_epilogue()
+        self._out.flush()
 
 def main():
     import argparse
@@ -1,4 +1,83 @@
 #!/usr/bin/env python3
+import mmap
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, repeat
+
+import numpy as np
+
+# data bytes per channel message, indexed by the status byte's high nibble:
+# Note Off, Note On, Polyphonic Key Pressure, Control Change -> 2,
+# Program Change, Channel Pressure -> 1, Pitch Bend -> 2
+_MSGLEN = bytes([0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 2, 2, 1, 1, 2, 0])
+
+def _read_varlength(buf, p):
+    """
+    Decode one varint at offset p, returns (value, new offset)
+    Unrolled with early exits, midi varints are at most 4 bytes
+    """
+    b = buf[p]
+    if b < 0x80:
+        return b, p+1
+    n = b & 0x7f
+    b = buf[p+1]
+    if b < 0x80:
+        return (n << 7) | b, p+2
+    n = (n << 7) | (b & 0x7f)
+    b = buf[p+2]
+    if b < 0x80:
+        return (n << 7) | b, p+3
+    n = (n << 7) | (b & 0x7f)
+    b = buf[p+3]
+    return (n << 7) | (b & 0x7f), p+4
+
+def _parse_track_data(data, division):
+    """
+    Parse one track's payload (the bytes after 'MTrk' + length)
+    Self-contained so tracks can be parsed in parallel worker processes
+    Returns (ticks, types, payload, ticks_per_second); ticks_per_second
+    is 0 unless the track contains a set-tempo event
+    """
+    ticks = array('I')
+    types = array('B')
+    payload = bytearray()
+    ticks_per_second = 0
+    last_msg_type = 0
+    tick_pos = 0
+    pos = 0
+    end = len(data)
+    while pos < end:
+        delta_time, pos = _read_varlength(data, pos)
+        tick_pos += delta_time
+        msg_type = data[pos]
+        pos += 1
+        if msg_type < 0x80: # midi-event, no status: reuse the previous status byte
+            pos -= 1
+            msg_type = last_msg_type
+        if 0x80 <= msg_type < 0xf0:
+            last_msg_type = msg_type
+            msg_len = _MSGLEN[msg_type >> 4]
+            if msg_type&0xe0 == 0x80: # Note-Off or Note-On
+                ticks.append(tick_pos)
+                types.append(msg_type)
+                payload += data[pos:pos+msg_len]
+            pos += msg_len
+        elif msg_type == 0xf0 or msg_type == 0xf7: # midi-event (F0) or sysex-event (F7)
+            msg_len, pos = _read_varlength(data, pos)
+            pos += msg_len
+        elif msg_type == 0xff: # meta-event
+            meta_type = data[pos]
+            pos += 1
+            msg_len, pos = _read_varlength(data, pos)
+            if meta_type == 0x51 and not ticks_per_second: # parse set-tempo (if not yet set)
+                if not division&0x8000: # but only for non-SMPTE divisions
+                    microseconds_per_quarternote = int.from_bytes(data[pos:pos+msg_len], 'big')
+                    quarternotes_per_second = 1_000_000/microseconds_per_quarternote
+                    ticks_per_second = quarternotes_per_second * division
+            pos += msg_len
+        else:
+            raise ValueError(f"Unexpected midi-event: {msg_type:02x}")
+    return ticks, types, payload, ticks_per_second
 
 class MidiFile:
     """
@@ -10,133 +89,125 @@ class MidiFile:
         self.ntrks = 0
         self.division = 0
         self.ticks_per_second = 0
+        # mmap the whole file and parse with a moving cursor,
+        # instead of many small f.read() calls
         with open(filename, 'rb') as f:
-            self._parse(f)
-
-    def _read_varlength(self, f):
-        n = 0
-        while True:
-            x = int.from_bytes(f.read(1))
-            n <<= 7
-            n |= x & 0x7f
-            if not x&0x80:
-                break
-        return n
-
-    def _read_u32(self, f):
-        return int.from_bytes(f.read(4), 'big')
-
-    def _read_u16(self, f):
-        return int.from_bytes(f.read(2), 'big')
-
-    def _parse_header(self, f):
-        hdr = f.read(4)
-        assert hdr == b'MThd', f"Expected 'MThd', got {hdr}"
-        assert self._read_u32(f) == 6
-        self.format = self._read_u16(f)
-        self.ntrks = self._read_u16(f)
-        self.division = self._read_u16(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = memoryview(mm)
+        self._pos = 0
+        try:
+            self._parse()
+        finally:
+            self._buf.release()
+            mm.close()
+
+    def _read(self, n):
+        data = self._buf[self._pos:self._pos+n]
+        self._pos += n
+        return data
+
+    def _read_u32(self):
+        return int.from_bytes(self._read(4), 'big')
+
+    def _read_u16(self):
+        return int.from_bytes(self._read(2), 'big')
+
+    def _parse_header(self):
+        hdr = self._read(4)
+        assert hdr == b'MThd', f"Expected 'MThd', got {bytes(hdr)}"
+        assert self._read_u32() == 6
+        self.format = self._read_u16()
+        self.ntrks = self._read_u16()
+        self.division = self._read_u16()
         if self.division & 0x8000: # parse SMPTE format
             n_frames_per_second = (self.division & 0x7f00) >> 8
             ticks_per_frame = self.division & 0xff
             self.ticks_per_second = n_frame_per_second * ticks_per_frame
 
-    def _msglen(self, statusbyte):
-        MSGLEN = {
-            0x80: 2, # Note Off
-            0x90: 2, # Note On
-            0xa0: 2, # Polyphonic Key Pressure
-            0xb0: 2, # Control Change
-            0xc0: 1, # Program Change
-            0xd0: 1, # Channel Pressure
-            0xe0: 2, # Pitch Bend
-        }
-        return MSGLEN[statusbyte & 0xf0]
-
-    def _parse_msg(self, f):
-        msg_type = int.from_bytes(f.read(1))
-        if msg_type < 0x80: # midi-event, no status
-            msg = bytes([msg_type]) + f.read(self._msglen(self._last_msg_type) - 1)
-            msg_type = self._last_msg_type
-            return msg_type, msg
-        elif 0x80 <= msg_type < 0xf0:
-            msg = f.read(self._msglen(msg_type))
-            self._last_msg_type = msg_type
-            return msg_type, msg
-        elif msg_type == 0xf0 or msg_type == 0xf7: # midi-event (F0) or sysex-event (F7)
-            msg_len = self._read_varlength(f)
-            msg = f.read(msg_len)
-            return msg_type, msg
-        elif msg_type == 0xff: # meta-event
-            msg_type = int.from_bytes(f.read(1))
-            msg_len = self._read_varlength(f)
-            msg = f.read(msg_len)
-            if msg_type == 0x51 and not self.ticks_per_second: # parse set-tempo (if not yet set)
-                if not self.division&0x8000: # but only for non-SMPTE divisions
-                    microseconds_per_quarternote = int.from_bytes(msg, 'big')
-                    quarternotes_per_second = 1_000_000/microseconds_per_quarternote
-                    self.ticks_per_second = quarternotes_per_second * self.division
-            return msg_type, msg
-        raise ValueError(f"Unexpected midi-event: {msg_type:02x}")
-
-
-    def _parse_track(self, f):
-        hdr = f.read(4)
-        assert hdr == b'MTrk', f"Expected 'MTrk', got {hdr}"
-        track_length = self._read_u32(f)
-        track = []
-        end_pos = f.tell() + track_length
-        tick_pos = 0
-        while f.tell() < end_pos:
-            delta_time = self._read_varlength(f)
-            tick_pos += delta_time
-            msg_type, msg = self._parse_msg(f)
-            track.append((tick_pos, msg_type, msg))
-        return track
-
-
-    def _parse(self, f):
-        self._parse_header(f)
+    def _parse(self):
+        self._parse_header()
+        # lightweight first pass: only locate the track chunks
+        chunks = []
         for _ in range(self.ntrks):
-            self.tracks.append(self._parse_track(f))
+            hdr = self._read(4)
+            assert hdr == b'MTrk', f"Expected 'MTrk', got {bytes(hdr)}"
+            track_length = self._read_u32()
+            chunks.append(bytes(self._read(track_length)))
+        # tracks are independent byte ranges, parse them in parallel
+        if len(chunks) > 1:
+            with ProcessPoolExecutor() as executor:
+                results = list(executor.map(_parse_track_data, chunks, repeat(self.division)))
+        else:
+            results = [_parse_track_data(chunk, self.division) for chunk in chunks]
+        for ticks, types, payload, ticks_per_second in results:
+            self.tracks.append((ticks, types, payload))
+            if ticks_per_second and not self.ticks_per_second:
+                self.ticks_per_second = ticks_per_second
 
     def note_events(self):
         """
         Return sorted list of note-on and note-off events across all tracks
         """
-        events_by_time = {}
-        for track in self.tracks:
-            for ts, control, msg in track:
-                if control&0xe0 == 0x80 : # Note-Off or Note-On
-                    channel = control&0x0f
-                    key = msg[0]
-                    on = control&0xf0 == 0x90 and msg[1] > 0 # only consider this a note-on event if the velocity if greater than 0
-                    if ts not in events_by_time:
-                        events_by_time[ts] = set()
-                    events_by_time[ts].add((on, channel, key))
-        min_ts = min(events_by_time.keys(), default=0)
-        return sorted((k-min_ts,sorted(v)) for k,v in events_by_time.items())
+        events = []
+        for ticks, types, payload in self.tracks:
+            # parsing only stores Note-Off/Note-On, always 2 payload bytes
+            for i, (ts, control) in enumerate(zip(ticks, types)):
+                channel = control&0x0f
+                key = payload[2*i]
+                on = control&0xf0 == 0x90 and payload[2*i+1] > 0 # only consider this a note-on event if the velocity if greater than 0
+                events.append((ts, on, channel, key))
+        if not events:
+            return []
+        # one sort instead of a dict of sets per timestamp;
+        # sorting also brings duplicates next to each other
+        events.sort()
+        min_ts = events[0][0]
+        result = []
+        for ts, group in groupby(events, key=lambda e: e[0]):
+            prev = None
+            group_events = []
+            for event in group:
+                if event != prev:
+                    group_events.append(event[1:])
+                    prev = event
+            result.append((ts-min_ts, group_events))
+        return result
 
     def monophone_notes_iter(self):
         """
-        Returns sorted list of (duration, {channel -> note})-pairs
+        Returns sorted list of (duration, keys)-pairs, where keys is a
+        (key0, key1, key2)-tuple with -1 marking an inactive channel
         For each channel, only consider the most recently played note
+        Only channels 0-2 are considered
         """
-        state = {}
+        state = [-1, -1, -1]
         note_events = self.note_events()
         for (ts, events), (next_ts, _) in zip(note_events, note_events[1:]):
             for on, channel, key in events:
+                if channel >= len(state):
+                    continue
                 if not on:
-                    if channel in state and state[channel] == key:
-                        del state[channel]
+                    if state[channel] == key:
+                        state[channel] = -1
                 else:
                     state[channel] = key
             duration = next_ts - ts
-            yield duration, sorted((k,v) for k,v in state.items())
+            yield duration, tuple(state)
 
     def monophone_notes(self):
         return list(self.monophone_notes_iter())
 
+    def monophone_notes_array(self):
+        """
+        Returns an (N, 4) int array of [duration_ticks, key0, key1, key2]
+        One row per event, -1 marks an inactive channel
+        Only channels 0-2 are considered
+        """
+        notes = self.monophone_notes()
+        if not notes:
+            return np.empty((0, 4), dtype=np.int64)
+        return np.array([(duration, *keys) for duration, keys in notes], dtype=np.int64)
+
 
 def main():
     import argparse
@@ -146,10 +217,10 @@ def main():
 
     mf = MidiFile(args.midifile)
     print(f"Midifile with {len(mf.tracks)} tracks, running at {mf.ticks_per_second} ticks/s")
-    for i,track in enumerate(mf.tracks):
+    for i,(ticks, types, payload) in enumerate(mf.tracks):
         print(f"Track {i}:")
-        for t, tp, m in track:
-            print(f"\t{t:8d}: {f'{tp:02x}' if tp else '-'} {m.hex(' ')}")
+        for j,(t, tp) in enumerate(zip(ticks, types)):
+            print(f"\t{t:8d}: {tp:02x} {payload[2*j:2*j+2].hex(' ')}")
         print("")
 
     print("Events:")
@@ -161,7 +232,7 @@ def main():
 
     print("Notes:")
     for duration, state in mf.monophone_notes():
-        print(f"{duration/mf.ticks_per_second:8.3f}s: {', '.join(f'{channel}:{key}' for channel,key in state)}")
+        print(f"{duration/mf.ticks_per_second:8.3f}s: {', '.join(f'{channel}:{key}' for channel,key in enumerate(state) if key >= 0)}")
 
 if __name__ == '__main__':
     main()